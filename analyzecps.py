@@ -3,8 +3,8 @@
 """Program that calculates the maximum daily call delay at a given calls-per-second rate,
 and displays a graph of the delay over the chosen time period.
 
-    usage: analyzecps.py [-h] [-s START] [-e END] [--cps CPS] [--version]
-                        [--log {debug,info,warning}]
+    usage: analyzecps.py [-h] [-s START] [-e END] [--cps CPS] [--parallel] 
+                        [--noplot] [--version] [--log {debug,info,warning}]
                         cps_file
 
     Analyze a CSV file of CPS counts to determine maximum call queuing time.
@@ -17,6 +17,8 @@ and displays a graph of the delay over the chosen time period.
     -s START, --start START     ignore records before this date/time (YYYY-MM-DD [HH:MM:SS]
     -e END, --end END           ignore records after this date/time (YYYY-MM-DD [HH:MM:SS])
     --cps CPS                   CPS value (default: interactive)
+    --parallel                  use all CPU cores to calculate queue times (needs Numba)
+    --noplot                    print the daily maxima without displaying the graph
     --version                   show program's version number and exit
     --log {debug,info,warning}  set logging level
 
@@ -35,11 +37,15 @@ import sys
 import argparse
 from datetime import datetime, timedelta
 import logging
-import csv
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter, DayLocator, HourLocator
 
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None     # Fall back to the NumPy queue time calculation
+
 
 __version__ = "1.0"
 
@@ -73,41 +79,161 @@ def get_args():
     parser.add_argument('-e', '--end', type=datetime.fromisoformat, 
                         help="ignore records after this date/time (YYYY-MM-DD [HH:MM:SS])")
     parser.add_argument('--cps', type=int, help="CPS value (default: interactive)")
+    parser.add_argument('--parallel', action='store_true', 
+                        help="use all CPU cores to calculate queue times (needs Numba)")
+    parser.add_argument('--noplot', action='store_true', 
+                        help="print the daily maxima without displaying the graph")
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('--log', choices=['debug', 'info', 'warning'], default='info', 
                         help="set logging level")
     return parser.parse_args()
 
 
-# Return the number of seconds in a timedelta.
-def num_seconds(delta):
-    return delta.days * 86400 + delta.seconds
-
-
 # At the start of the period, the queue size is assumed to be zero.  For each second,
 # we add the number of calls offered and subtract the CPS value (except that the queue
 # size can never be below zero), and divide by the CPS value to get queue time in seconds.
-def calculate_queue_time(cps_array, queue_time, cps):
+#
+# Without the floor at zero, the queue size would simply be the running total S of 
+# (calls - CPS).  The floor adds back the lowest point that S has reached so far, if
+# that is negative, so the queue size is S - min(0, running minimum of S).  This lets 
+# NumPy do the work using cumulative operations, without a Python loop.
+def _queue_time_cumsum(cps_array, queue_time, cps):
+    queue_size = np.cumsum(cps_array.astype(np.int64) - cps)
+    lowest = np.minimum(queue_size, 0)
+    np.minimum.accumulate(lowest, out=lowest)
+    queue_size -= lowest
+    np.divide(queue_size, cps, out=queue_time, casting='unsafe')
+
+
+# The queue size recurrence is inherently sequential, so if Numba is available we 
+# compile the loop to native code rather than run it in the interpreter.  We also note
+# the longest queue on each day as we go, rather than search the queue times afterwards.
+#
+# _queue_days() calculates the queue sizes for a range of whole days, given the running 
+# total of (calls - CPS) and its lowest point before the first of them.  The queue times
+# themselves are only stored if keep_full is set, e.g. for plotting.  The queue time
+# array is passed in, so that it can be reused for each CPS value.
+if njit:
+    @njit(cache=True, fastmath=True)
+    def _queue_days(cps_array, cps, first_day, last_day, total, floor, 
+                    keep_full, queue_time, max_indices, max_sizes):
+        n = len(cps_array)
+        for day in range(first_day, last_day):
+            max_index = day * 86400
+            max_size = -1
+            for i in range(day * 86400, min((day + 1) * 86400, n)):
+                total += cps_array[i] - cps
+                if total < floor: floor = total
+                queue_size = total - floor
+                if queue_size > max_size:
+                    max_size = queue_size
+                    max_index = i
+                if keep_full: queue_time[i] = queue_size / cps
+            max_indices[day] = max_index
+            max_sizes[day] = max_size
+
+    @njit(cache=True, fastmath=True)
+    def _queue_time_kernel(cps_array, queue_time, cps, keep_full):
+        n = len(cps_array)
+        num_days = (n + 86399) // 86400
+        max_indices = np.empty(num_days, dtype=np.int64)
+        max_sizes = np.empty(num_days, dtype=np.int64)
+        _queue_days(cps_array, cps, 0, num_days, 0, 0, 
+                    keep_full, queue_time, max_indices, max_sizes)
+        return max_indices, max_sizes
+
+
+# Parallel version of the queue time kernel.  The period is split into one chunk of
+# whole days per thread.  The first pass finds the running total at the end of each 
+# chunk, and its lowest point within the chunk; from these, we can work out the running
+# total and the queue size floor at the start of every chunk, so that the second pass 
+# can calculate the queue times for all the chunks at once.
+if njit:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _parallel_queue_time_kernel(cps_array, queue_time, cps, keep_full, num_chunks):
+        n = len(cps_array)
+        num_days = (n + 86399) // 86400
+        days_per_chunk = max(1, (num_days + num_chunks - 1) // num_chunks)
+        num_chunks = (num_days + days_per_chunk - 1) // days_per_chunk
+        chunk_size = days_per_chunk * 86400
+        totals = np.zeros(num_chunks, dtype=np.int64)
+        lowest = np.zeros(num_chunks, dtype=np.int64)
+
+        for k in prange(num_chunks):
+            total = 0
+            low = 0
+            for i in range(k * chunk_size, min((k + 1) * chunk_size, n)):
+                total += cps_array[i] - cps
+                if total < low: low = total
+            totals[k] = total
+            lowest[k] = low
+
+        offsets = np.zeros(num_chunks, dtype=np.int64)     # Running total before each chunk
+        floors = np.zeros(num_chunks, dtype=np.int64)      # Lowest running total before each chunk
+        for k in range(1, num_chunks):
+            offsets[k] = offsets[k - 1] + totals[k - 1]
+            floors[k] = min(floors[k - 1], offsets[k - 1] + lowest[k - 1])
+
+        max_indices = np.empty(num_days, dtype=np.int64)
+        max_sizes = np.empty(num_days, dtype=np.int64)
+        for k in prange(num_chunks):
+            _queue_days(cps_array, cps, k * days_per_chunk, min((k + 1) * days_per_chunk, num_days),
+                        offsets[k], floors[k], keep_full, queue_time, max_indices, max_sizes)
+        return max_indices, max_sizes
+
+
+# Fill in the queue times, in seconds, for each second of the period, and return a list
+# of (datetime, float secs) tuples for the daily maxima.  If Numba is available, the 
+# queue time array may be None, when only the maxima are wanted.
+def calculate_queue_time(cps_array, queue_time, cps, start, parallel=False):
     logger.debug("Calculating queue times...")
-    queue_size = 0
-    for i in range(len(cps_array)):
-        queue_size = max(0, queue_size + cps_array[i] - cps)
-        queue_time[i] = queue_size / cps
+    if not njit:
+        _queue_time_cumsum(cps_array, queue_time, cps)
+        return get_daily_maxima(start, queue_time)
+
+    keep_full = queue_time is not None
+    if not keep_full: queue_time = np.empty(0, dtype=np.single)
+
+    if parallel:
+        max_indices, max_sizes = _parallel_queue_time_kernel(
+            cps_array, queue_time, cps, keep_full, get_num_threads())
+    else:
+        max_indices, max_sizes = _queue_time_kernel(cps_array, queue_time, cps, keep_full)
+
+    max_times = (max_sizes / cps).astype(np.single)
+    return [(start + timedelta(seconds=int(index)), max_time) 
+            for index, max_time in zip(max_indices, max_times)]
+
+
+# Compile the queue time kernel (or load it from the on-disk cache) with an explicit
+# signature, for the CPS array type and the mode actually in use.  This is done once 
+# the data has been loaded, so that --help and argument errors don't wait for it, and
+# so that the first CPS value entered runs at native speed.
+def compile_kernel(cps_type, parallel=False):
+    if njit:
+        logger.debug("Compiling queue time calculation...")
+        cps_array = f'{np.dtype(cps_type).name}[::1]'
+        if parallel:
+            _parallel_queue_time_kernel.compile(f'({cps_array}, float32[::1], int64, boolean, int64)')
+        else:
+            _queue_time_kernel.compile(f'({cps_array}, float32[::1], int64, boolean)')
 
 
 # Return a list of (datetime, float secs) tuples for the time period.  We split the
-# period into 24-hour chunks, starting at the beginning value.
+# period into 24-hour chunks, starting at the beginning value.  The whole days are
+# viewed as a 2-D array, one row per day, so that a single argmax finds every daily 
+# maximum; any part day at the end is handled separately.
 def get_daily_maxima(start, queue_time):
     logger.debug("Finding daily maxima...")
-    maxima = []
-    start_index = 0
-    while start_index < len(queue_time):
-        end_index = min(start_index + 86400, len(queue_time))
-        daily_max_index = start_index + int(np.argmax(queue_time[start_index:end_index]))
-        daily_max = start + timedelta(seconds=daily_max_index)
-        maxima.append((daily_max, queue_time[daily_max_index]))
-        start_index = end_index
-    return maxima
+    num_days = len(queue_time) // 86400
+    whole_days = queue_time[:num_days * 86400].reshape(num_days, 86400)
+    indices = whole_days.argmax(axis=1) + np.arange(0, num_days * 86400, 86400)
+
+    if len(queue_time) > num_days * 86400:
+        part_day = queue_time[num_days * 86400:]
+        indices = np.append(indices, num_days * 86400 + np.argmax(part_day))
+
+    return [(start + timedelta(seconds=int(index)), queue_time[index]) for index in indices]
 
 
 def print_maxima(maxima, cps):
@@ -151,61 +277,82 @@ def plot_results(dt_array, queue_time, cps, start, end_dt):
 
 def main(args):
     configure_logging(level=getattr(logging, args.log.upper()))
-    logger.debug("Reading CPS file into memory...")
+    if args.parallel and not njit:
+        logger.warning("Numba is not installed, so queue times will not be calculated in parallel")
 
-    num_read = 0
-    intervals = []  # Each entry is a (datetime, int) tuple
-    earliest = datetime.max 
-    latest = datetime.min 
+    logger.debug("Reading CPS file into memory...")
 
+    # Parse the whole file in one go.  Only the first 19 characters of each date/time 
+    # are kept, i.e. YYYY-MM-DD HH:MM:SS, so any fractional seconds are ignored.
     with args.cps_file as cps_file:
-        cps_lines = csv.DictReader(cps_file, fieldnames=['dt', 'cps'])
-        for cps_line in cps_lines:
-            num_read += 1
-            dt = datetime.fromisoformat(cps_line['dt'])
-
-            # Filter records outside of the chosen period.
-            if args.start and dt < args.start: continue
-            if args.end and dt >= args.end: continue            
-
-            # We can't guarantee that the records are in order, so note the earliest and latest.
-            if dt < earliest: earliest = dt
-            if dt > latest: latest = dt
-
-            cps = int(cps_line['cps'])
-            intervals.append((dt, cps))
+        cps_lines = np.loadtxt(
+            cps_file, delimiter=',', dtype=[('dt', 'U19'), ('cps', np.int32)], ndmin=1)
+
+    num_read = len(cps_lines)
+    dts = cps_lines['dt'].astype('datetime64[s]')
+    counts = cps_lines['cps']
+
+    # Filter records outside of the chosen period.  CPS files written by countcps.py are
+    # in date/time order, so the period can be found by binary search, without copying
+    # the arrays; otherwise we have to use a mask.
+    in_order = bool(np.all(dts[1:] >= dts[:-1]))
+    if in_order:
+        first = np.searchsorted(dts, np.datetime64(args.start)) if args.start else 0
+        last = np.searchsorted(dts, np.datetime64(args.end)) if args.end else num_read
+        dts = dts[first:last]
+        counts = counts[first:last]
+    else:
+        in_period = np.ones(num_read, dtype=bool)
+        if args.start: in_period &= dts >= np.datetime64(args.start)
+        if args.end: in_period &= dts < np.datetime64(args.end)
+        dts = dts[in_period]
+        counts = counts[in_period]
 
-    if not intervals:
+    if not len(dts):
         sys.exit("No records found in the specified time period")
 
+    # Note the earliest and latest, as datetimes.
+    if in_order:
+        earliest, latest = dts[0].item(), dts[-1].item()
+    else:
+        earliest, latest = dts.min().item(), dts.max().item()
+
     logger.debug(
         "%s entries read, %s kept, earliest: %s, latest: %s", 
-        num_read, len(intervals), earliest, latest)
+        num_read, len(dts), earliest, latest)
 
     # Adjust start and end date/times if they were not explicitly set.
     start = args.start if args.start else earliest
     end = args.end if args.end else latest + ONE_SECOND
 
-    # Calculate how long our CPS and queue_time arrays need to be.
-    # Each entry represents a one second duration.
-    num_entries = num_seconds(end - start)
+    # From here on, we work in whole seconds since the epoch.  Calculate how long our 
+    # CPS and queue_time arrays need to be; each entry represents a one second duration.
+    start = start.replace(microsecond=0)
+    start_secs = np.datetime64(start, 's').astype(np.int64)
+    end_secs = np.datetime64(end, 's').astype(np.int64)
+    num_entries = int(end_secs - start_secs)
     logger.debug("CPS array contains %s entries", num_entries)
 
-    # Create the arrays and load the CPS array from the intervals read.
-    dt_array = np.arange(start, end, dtype='datetime64[s]')
-    cps_array = np.zeros(num_entries, dtype=np.int32)
-    queue_time = np.zeros(num_entries, dtype=np.single)
+    # Create the arrays and load the CPS array from the intervals read, using each
+    # interval's offset in seconds from the start as its index.
+    if not args.noplot: dt_array = np.arange(start_secs, end_secs).astype('datetime64[s]')
+
+    # Per-second counts should fit in 16 bits, which halves the memory that the queue 
+    # time calculation has to read, but we'll use 32 bits if necessary.
+    cps_type = np.int16 if counts.max() <= np.iinfo(np.int16).max else np.int32
+    cps_array = np.zeros(num_entries, dtype=cps_type)
+    cps_array[dts.astype(np.int64) - start_secs] = counts
 
-    for interval in intervals:
-        index = num_seconds(interval[0] - start)    # interval[0] contains a datetime
-        cps_array[index] = interval[1]              # interval[1] is the corresponding count
+    # The queue time array is allocated once, and reused for each CPS value.  If Numba
+    # finds the daily maxima and there's no graph to plot, we don't need it at all.
+    queue_time = None if args.noplot and njit else np.zeros(num_entries, dtype=np.single)
+    compile_kernel(cps_type, args.parallel)
 
     # If a CPS was specified, calculate the daily maxima.
     if args.cps:
-        calculate_queue_time(cps_array, queue_time, args.cps)
-        maxima = get_daily_maxima(start, queue_time)
+        maxima = calculate_queue_time(cps_array, queue_time, args.cps, start, args.parallel)
         print_maxima(maxima, args.cps)
-        plot_results(dt_array, queue_time, args.cps, start, end)
+        if not args.noplot: plot_results(dt_array, queue_time, args.cps, start, end)
 
     # Otherwise prompt for CPS interactively.
     else:
@@ -216,10 +363,9 @@ def main(args):
 
             try:
                 cps = int(response)
-                calculate_queue_time(cps_array, queue_time, cps)
-                maxima = get_daily_maxima(start, queue_time)
+                maxima = calculate_queue_time(cps_array, queue_time, cps, start, args.parallel)
                 print_maxima(maxima, cps)
-                plot_results(dt_array, queue_time, cps, start, end)
+                if not args.noplot: plot_results(dt_array, queue_time, cps, start, end)
             except ValueError:
                 continue
 
@@ -47,10 +47,18 @@ included in the CDR file are outbound calls.
 
 import sys
 import argparse
-from datetime import datetime, timedelta
+from datetime import datetime
 import csv
 import logging
-from decimal import Decimal
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None       # Fall back to the pandas CSV reader
 
 
 __version__ = "1.0"
@@ -64,6 +72,28 @@ DATETIME_FORMATS = {
     'ISO': None                                             # e.g. "2020-09-10 14:52:06.000"
 }
 
+# Positions of the fields in the fixed-width datetime formats, as (start, end) slices.
+# Negative positions count back from the end of the string, so that the Console format
+# works with any length of timezone name.
+FIXED_WIDTH_FORMATS = {
+    DATETIME_FORMATS['Monkey']: {
+        'day': (5, 7), 'month': (8, 11), 'year': (12, 16), 
+        'hour': (17, 19), 'minute': (20, 22), 'second': (23, 25),
+        'offset_sign': (26, 27), 'offset_hour': (27, 29), 'offset_minute': (29, 31)},
+    DATETIME_FORMATS['Console']: {
+        'hour': (0, 2), 'minute': (3, 5), 'second': (6, 8), 
+        'year': (-10, -6), 'month': (-5, -3), 'day': (-2, 0)},
+}
+
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# pandas 2 infers a single format from the first ISO date/time, and rejects values of
+# any other precision, unless told to expect ISO 8601 in general; earlier versions 
+# parse each value on its own, as datetime.fromisoformat() does.
+ISO_FORMAT = 'ISO8601' if int(pd.__version__.split('.')[0]) >= 2 else None
+
+MAX_ERROR_LINES = 10        # Maximum number of bad CDR lines to show
+
 logger = logging.getLogger(__name__)
 
 
@@ -221,8 +251,8 @@ def detect_cdr_type(args):
 
     # Let's initially assume the CDR file has a header, and get the field names. 
     cdr_info = CDRinfo()
-    reader = csv.DictReader(args.cdr_file)
-    fieldnames = reader.fieldnames
+    reader = csv.reader(args.cdr_file)
+    fieldnames = next(reader, None)
 
     if fieldnames is None:
         sys.exit("Error: CDR file is empty!")
@@ -244,7 +274,7 @@ def detect_cdr_type(args):
     # If there's a header, get the next row to use as a sample. 
     if cdr_info.has_header:
         try:
-            sample_row = next(reader).values()
+            sample_row = next(row for row in reader if row)     # Skip any blank lines
             logger.debug("Sample row: %s", sample_row)
         except StopIteration:
             sys.exit("Error: CDR file contains no call records!")
@@ -342,13 +372,7 @@ def adjust_start_and_end_times(start, end, cdr_tz, given_tz):
 
 def calculate_spread(intervals):
     logger.debug("Calculating spread...")
-    spread = {}
-    for value in intervals.values():
-        if value in spread.keys():
-            spread[value] += 1
-        else:
-            spread[value] = 1
-    return spread
+    return Counter(intervals.tolist())
 
 
 def print_spread(spread):
@@ -372,76 +396,224 @@ def print_queue_times(queue_times):
     print()
 
 
+# Read the columns we need from the CDR file into a DataFrame of strings, using the
+# PyArrow CSV reader if it's installed.  If there's no header row, the columns are 
+# selected by position, and named by their positions (indexed from 1), as in 
+# DEFAULT_FIELDNAMES.
+def read_cdrs(cdr_file, cdr_info):
+    columns = [
+        col_id for col_id in (
+            cdr_info.start_col_id, 
+            cdr_info.flags_col_id, 
+            cdr_info.direction_col_id, 
+            cdr_info.queuetime_col_id)
+        if col_id]
+
+    if pa:
+        if cdr_info.has_header:
+            read_options = pa_csv.ReadOptions()
+            file_columns = columns
+        else:
+            read_options = pa_csv.ReadOptions(autogenerate_column_names=True)
+            file_columns = [f'f{int(col_id) - 1}' for col_id in columns]   # f0, f1, ...
+
+        convert_options = pa_csv.ConvertOptions(
+            include_columns=file_columns, 
+            column_types={col: pa.string() for col in file_columns})
+        cdrs = pa_csv.read_csv(
+            cdr_file.buffer, read_options=read_options, convert_options=convert_options)
+        return cdrs.rename_columns(columns).to_pandas()
+
+    if cdr_info.has_header:
+        return pd.read_csv(cdr_file, usecols=columns, dtype=str)
+    else:
+        positions = sorted(int(col_id) - 1 for col_id in columns)   # Columns are read in file order
+        cdrs = pd.read_csv(cdr_file, header=None, usecols=positions, dtype=str)
+        cdrs.columns = [str(position + 1) for position in positions]
+        return cdrs
+
+
+# Parse date/time strings in one of the FIXED_WIDTH_FORMATS much faster than strptime()
+# can, by treating them as a 2-D array of characters, and picking out the digits of each
+# field by position.  Returns an array of seconds since the epoch (UTC, if the format
+# has a timezone offset), or None if the strings don't fit the format.
+def parse_fixed_width(column, layout):
+    try:
+        chars = column.to_numpy(dtype=bytes)
+    except (ValueError, TypeError):
+        return None     # Not ASCII
+
+    width = chars.dtype.itemsize
+    if not len(chars) or np.any(np.char.str_len(chars) != width):
+        return None
+    chars = chars.view(np.uint8).reshape(-1, width)
+
+    def field(name):
+        start, end = layout[name]
+        return chars[:, start + width if start < 0 else start : end + width if end <= 0 else end]
+
+    def number(name, low, high):
+        digits = field(name).astype(np.int64) - ord('0')
+        if np.any((digits < 0) | (digits > 9)): raise ValueError(name)
+        value = np.zeros(len(chars), dtype=np.int64)
+        for i in range(digits.shape[1]):
+            value = value * 10 + digits[:, i]
+        if np.any((value < low) | (value > high)): raise ValueError(name)
+        return value
+
+    def month():
+        letters = field('month').astype(np.int64)
+        if letters.shape[1] == 2: return number('month', 1, 12)
+        codes = letters[:, 0] << 16 | letters[:, 1] << 8 | letters[:, 2]
+        names = np.array([ord(a) << 16 | ord(b) << 8 | ord(c) for a, b, c in MONTH_NAMES])
+        order = np.argsort(names)
+        found = np.minimum(np.searchsorted(names, codes, sorter=order), 11)
+        if np.any(names[order[found]] != codes): raise ValueError('month')
+        return order[found] + 1
+
+    def first_days(months):     # Days since the epoch of the first of each month
+        return months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+    # Out of range values are rejected, as strptime() would, rather than being carried
+    # into the next field up, e.g. the 32nd of a month becoming the 1st of the next.
+    try:
+        months = (number('year', 1, 9999) - 1970) * 12 + month() - 1
+        days = first_days(months)
+        day = number('day', 1, 31)
+        if np.any(day > first_days(months + 1) - days): raise ValueError('day')
+        days += day - 1
+        secs = (days * 86400 + number('hour', 0, 23) * 3600 
+                + number('minute', 0, 59) * 60 + number('second', 0, 59))
+        if 'offset_sign' in layout:
+            offsets = number('offset_hour', 0, 23) * 3600 + number('offset_minute', 0, 59) * 60
+            secs -= np.where(field('offset_sign')[:, 0] == ord('-'), -offsets, offsets)
+        return secs
+    except ValueError:
+        return None
+
+
+# Convert a column of date/time strings into a Series of datetimes.  Pandas can't parse
+# timezone names, so those are removed (datetime.strptime() ignores them anyway).  
+# ISO date/times may mix precisions, e.g. with and without milliseconds.  Timezone-aware
+# values are converted to the timezone found in the CDR file.
+def parse_datetimes(column, cdr_info):
+    fmt = cdr_info.datetime_format
+    aware = cdr_info.tzinfo is not None
+    secs = parse_fixed_width(column, FIXED_WIDTH_FORMATS[fmt]) if fmt else None
+
+    if secs is not None:
+        datetimes = pd.Series(pd.to_datetime(secs, unit='s', utc=aware), index=column.index)
+    else:
+        if fmt and '%Z' in fmt:
+            column = column.str.replace(r' [A-Z]+ ', ' ', regex=True)
+            fmt = fmt.replace(' %Z', '')
+        datetimes = pd.to_datetime(column, format=fmt or ISO_FORMAT, utc=aware)
+
+    return datetimes.dt.tz_convert(cdr_info.tzinfo) if aware else datetimes
+
+
+# Count the calls in each one-second interval, returning a Series of counts indexed by
+# date/time, in date/time order.  The start times are converted to whole seconds since 
+# the epoch, so that np.bincount() can do the counting.  But bincount needs a counter 
+# for every second in the period, so if the calls are sparse over a long period, we 
+# sort and count the distinct seconds with np.unique() instead.
+def count_intervals(call_starts):
+    if call_starts.empty:
+        return pd.Series(dtype=np.int64)
+
+    secs = call_starts.to_numpy(dtype='datetime64[s]').astype(np.int64)
+    first = secs.min()
+    if secs.max() - first < 8 * len(secs):
+        counts = np.bincount(secs - first)
+        offsets = np.flatnonzero(counts)
+        secs, counts = offsets + first, counts[offsets]
+    else:
+        secs, counts = np.unique(secs, return_counts=True)
+    return pd.Series(counts, index=pd.to_datetime(secs, unit='s'))
+
+
+# Write the CPS intervals as "YYYY-MM-DD HH:MM:SS,count" lines.  The file is built as a
+# single string and written in one go, which is quicker than DataFrame.to_csv().
+def write_intervals(cps_file, intervals):
+    dts = np.datetime_as_string(intervals.index.to_numpy(dtype='datetime64[s]')).tolist()
+    lines = [f'{dt},{count}\n' for dt, count in zip(dts, intervals.tolist())]
+    cps_file.write(''.join(lines).replace('T', ' '))     # ISO 'T' separator becomes a space
+
+
 def main(args):
     configure_logging(level=getattr(logging, args.log.upper()))
     cdr_info = detect_cdr_type(args)
     start, end = adjust_start_and_end_times(args.start, args.end, cdr_info.tzinfo, args.tz)
 
     logger.debug("Reading CSV file...")
-    intervals = {}
     queue_times = {}
-    num_read = 0
-    num_counted = 0
-    num_written = 0
 
     with args.cdr_file as cdr_file:
-        cdrs = csv.DictReader(cdr_file, fieldnames=None if cdr_info.has_header else DEFAULT_FIELDNAMES)
-        for cdr in cdrs:
-            try:
-                num_read += 1
-
-                # Filter all but Outgoing API calls, if the CDRs were exported from Monkey, Looker or 
-                # Twilio Console.  If not from these sources, the CDR file should be pre-filtered.
-                # Flags definition can be found here: https://wiki.hq.twilio.com/display/RT/Call (Twilions only).
-                if cdr_info.flags_col_id and (int(cdr[cdr_info.flags_col_id]) & 0x0002 != 2): 
-                    continue
-                if cdr_info.direction_col_id and (cdr[cdr_info.direction_col_id] not in ['Outgoing API', 'outbound-api']): 
-                    continue
-
-                # Get the call start date/time, according to the format of the source. 
-                if cdr_info.datetime_format is None:
-                    call_start = datetime.fromisoformat(cdr[cdr_info.start_col_id])
-                else:
-                    call_start = datetime.strptime(
-                        cdr[cdr_info.start_col_id], 
-                        cdr_info.datetime_format)
-
-                # If the call was queued, add it to a tally for the queue length, and adjust the start time.
-                if cdr_info.queuetime_col_id:
-                    queue_time = Decimal(cdr[cdr_info.queuetime_col_id]) / 1000  # Result in seconds
-
-                    if queue_time in queue_times.keys():
-                        queue_times[queue_time] += 1
-                    else:
-                        queue_times[queue_time] = 1
-
-                    if queue_time > 0:
-                        call_start -= timedelta(seconds=int(queue_time))
-                
-                # Filter records outside of the chosen period.
-                if start and call_start < start: continue
-                if end and call_start >= end: continue
-                
-                # Count the call against its CPS interval.
-                num_counted += 1
-                if call_start in intervals.keys():
-                    intervals[call_start] += 1
-                else:
-                    intervals[call_start] = 1
-
-            except Exception as err:
-                logger.error("Line: %s", cdr)
-                sys.exit(f"Problem parsing CDR file: {str(err)}")
+        try:
+            cdrs = read_cdrs(cdr_file, cdr_info)
+            num_read = len(cdrs)
+
+            # Filter all but Outgoing API calls, if the CDRs were exported from Monkey, Looker or 
+            # Twilio Console.  If not from these sources, the CDR file should be pre-filtered.
+            # Flags definition can be found here: https://wiki.hq.twilio.com/display/RT/Call (Twilions only).
+            # The tests are combined into a single mask, so the rows are only selected once.
+            if cdr_info.flags_col_id or cdr_info.direction_col_id:
+                outgoing = np.ones(len(cdrs), dtype=bool)
+                if cdr_info.flags_col_id:
+                    flags = cdrs[cdr_info.flags_col_id].to_numpy(dtype=np.int32)
+                    outgoing &= (flags & 0x0002).astype(bool)
+                if cdr_info.direction_col_id:
+                    directions = cdrs[cdr_info.direction_col_id]
+                    outgoing &= directions.isin(['Outgoing API', 'outbound-api']).to_numpy()
+                cdrs = cdrs[outgoing]
+
+            # Get the call start date/times, according to the format of the source. 
+            call_starts = parse_datetimes(cdrs[cdr_info.start_col_id], cdr_info)
+
+            # A blank start time is parsed as NaT rather than raising an error, so check for
+            # them here, and show the offending lines (the first few, if there are many).  Only
+            # the selected fields were read, so those are shown, labelled with their names.
+            missing = call_starts.isna().to_numpy()
+            if missing.any():
+                first_line = 2 if cdr_info.has_header else 1
+                for index, cdr in cdrs[missing].head(MAX_ERROR_LINES).iterrows():
+                    fields = ', '.join(f"{name}='{value}'" for name, value in cdr.fillna('').items())
+                    logger.error("Line %s, selected fields: %s", index + first_line, fields)
+                sys.exit(f"Problem parsing CDR file: {missing.sum()} record(s) have no start time")
+
+            # If calls were queued, tally the queue lengths, and adjust the start times.
+            # The tally is kept in milliseconds; only the distinct values are converted to seconds.
+            if cdr_info.queuetime_col_id:
+                queue_time_ms = cdrs[cdr_info.queuetime_col_id].to_numpy(dtype=np.int64)
+                values, counts = np.unique(queue_time_ms, return_counts=True)
+                queue_times = dict(zip(values / 1000, counts))
+                call_starts -= pd.to_timedelta(np.maximum(queue_time_ms, 0) // 1000, unit='s')
+
+            # Filter records outside of the chosen period, again selecting the rows only once.
+            if start or end:
+                in_period = np.ones(len(call_starts), dtype=bool)
+                if start: in_period &= (call_starts >= start).to_numpy()
+                if end: in_period &= (call_starts < end).to_numpy()
+                call_starts = call_starts[in_period]
+
+            # The CPS file contains local date/times without timezone offsets.
+            if cdr_info.tzinfo:
+                call_starts = call_starts.dt.tz_localize(None)
+
+            # Count the calls against their CPS intervals.
+            num_counted = len(call_starts)
+            intervals = count_intervals(call_starts)
+
+        except Exception as err:
+            sys.exit(f"Problem parsing CDR file: {str(err)}")
 
     logger.debug("%s records read, %s records counted", num_read, num_counted)
     logger.debug("Writing CPS file...")
 
     with args.cps_file as cps_file:
-        for key, value in intervals.items():
-            num_written += 1
-            print(f'{key},{value}', file=cps_file)
+        write_intervals(cps_file, intervals)
 
-    logger.debug("%s records written", num_written)
+    logger.debug("%s records written", len(intervals))
 
     if args.spread:
         print_spread(calculate_spread(intervals))
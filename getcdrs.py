@@ -3,12 +3,13 @@
 """Get the CDRs from a Twilio account for a specified time period.
 
 usage: getcdrs.py [-h] [-s START] [-e END] [--tz TZ] [-a ACCOUNT] [-p PW]
-                  [--subs] [--fields FIELDS] [--version]
+                  [--subs] [--fields FIELDS] [--shards SHARDS] [--version]
                   [--log {debug,info,warning}]
                   cdr_file
 
     positional arguments:
-    cdr_file                    output CSV file
+    cdr_file                    output CSV file (gzipped if the name ends in .gz,
+                                or - for standard output)
 
     optional arguments:
     -h, --help                  show this help message and exit
@@ -23,6 +24,8 @@ usage: getcdrs.py [-h] [-s START] [-e END] [--tz TZ] [-a ACCOUNT] [-p PW]
     -p PW, --pw PW              auth token (default: TWILIO_AUTH_TOKEN env var)
     --subs                      include subaccounts
     --fields FIELDS             comma-separated list of desired fields (default: all)
+    --shards SHARDS             split the period into this many parts, fetched in
+                                parallel (default: 1)
     --version                   show program's version number and exit
     --log {debug,info,warning}  set logging level
 
@@ -34,12 +37,21 @@ parameters in a file, one parameter per line.
 
 import os
 import sys
+import io
+import re
+import gzip
+import time
 import argparse
 import logging
-import csv
-from datetime import datetime
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioException
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import attrgetter
+
+# The Twilio library (and csv) are imported where they're used, once the arguments are
+# known to be good, so that --help and argument errors don't wait for them to load.
 
 
 __version__ = "1.1.1"
@@ -71,6 +83,27 @@ CDR_FIELDS = [
     "queue_time",
     "trunk_sid",
 ]
+CDR_FIELDS_SET = frozenset(CDR_FIELDS)
+
+# Special case because 'from' is a reserved word in Python; must use 'from_' instead.
+PYTHONIC_FIELD_MAP = {field: 'from_' if field == 'from' else field for field in CDR_FIELDS}
+PYTHONIC_CDR_FIELDS = tuple(PYTHONIC_FIELD_MAP[field] for field in CDR_FIELDS)
+
+# Free-text fields, which may contain characters that need quoting in a CSV file.
+RISKY_FIELDS = frozenset(["to_formatted", "from_formatted", "annotation", "caller_name"])
+
+BATCH = 1024                # Number of CDRs written to the CSV file at a time
+CHUNK_SIZE = 4 << 20        # Size of the chunks written to the output file
+GZIP_LEVEL = 1              # Fastest compression, so that it keeps up with the writing
+QUEUE_SIZE = 16             # Number of batches of CDRs that may be waiting to be written
+MAX_WORKERS = 8             # Maximum number of accounts whose CDRs are fetched at once
+MAX_THREADS = 32            # Limit on fetcher threads, however many shards are asked for
+PAGE_SIZE = 1000            # Number of CDRs per request to Twilio (the most it allows)
+
+TZ_OFFSET = re.compile(r'([+-])(\d{2})(:?)([0-5]\d)(?:\3([0-5]\d)(?:\.(\d{1,6}))?)?|Z')
+NEEDS_QUOTING = re.compile(r'["\r\n]')     # Characters (besides commas) that must be quoted
+LINE_END = '\r\n'                          # Same line terminator as the CSV writer
+UTC_FORMAT = '%Y-%m-%dT%H:%M:%SZ'           # Date/time format for Twilio API filters
 
 logger = logging.getLogger(__name__)
 
@@ -84,28 +117,54 @@ def configure_logging(level=logging.INFO):
     logger.addHandler(handler)
 
 
+# Parse a timezone offset in the form ±HHMM and return a tzinfo object.  We do this by
+# hand, because strptime() is slow to import and run just to read a fixed offset, but
+# we accept the same forms as its %z directive: Z, or ±HH[:]MM[[:]SS[.ffffff]], with
+# the colons used consistently.  Results are cached, in case the same offset is parsed 
+# more than once.
+@lru_cache(maxsize=None)
+def parse_tz_offset(offset):
+    match = TZ_OFFSET.fullmatch(offset.strip())
+    if not match: raise ValueError(f"Invalid timezone offset: {offset}")
+    sign, hours, _, minutes, seconds, fraction = match.groups()
+    if not sign: return timezone.utc
+    delta = timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds or 0), 
+                      microseconds=int((fraction or '0').ljust(6, '0')))
+    return timezone(-delta if sign == '-' else delta)
+
+
 # Return parsed and validated command line arguments.
 def get_args():
 
     # Convert CSV string into list of fields.
     def field_list(str):
-        fields = str.lower().split(',')
-        fields = [f.strip() for f in fields]    # Remove whitespace
-        fields = [f for f in fields if f]       # Remove empty elements
+        # Remove whitespace and empty elements.
+        fields = [f for f in (part.strip().lower() for part in str.split(',')) if f]
 
         if not fields: raise argparse.ArgumentTypeError("argument is empty")
 
-        for field in fields:
-            if field not in CDR_FIELDS:
-                raise argparse.ArgumentTypeError(f"{field} is not a recognized CDR field")
+        unknown = set(fields) - CDR_FIELDS_SET
+        if len(unknown) == 1:
+            raise argparse.ArgumentTypeError(f"{unknown.pop()} is not a recognized CDR field")
+        elif unknown:
+            raise argparse.ArgumentTypeError(
+                f"{', '.join(sorted(unknown))} are not recognized CDR fields")
 
         return fields     
 
+    # Check that the number of shards is a positive integer.
+    def positive_int(str):
+        try:
+            value = int(str)
+        except ValueError:
+            value = 0
+        if value < 1: raise argparse.ArgumentTypeError("argument must be a positive integer")
+        return value
+
     # Parse a timezone offset and return a tzinfo object.
     def tzinfo(str):
         try:
-            dt = datetime.strptime(str, '%z')
-            return dt.tzinfo
+            return parse_tz_offset(str)
         except ValueError:
             raise argparse.ArgumentTypeError(
                 "Timezone offset should be a signed value in the form ±HHMM")
@@ -126,8 +185,8 @@ def get_args():
                 "parameters in a file, one parameter per line."),
         fromfile_prefix_chars='@')
     parser.add_argument(
-        'cdr_file', type=argparse.FileType('w'), 
-        help="output CSV file")
+        'cdr_file', 
+        help="output CSV file (gzipped if the name ends in .gz, or - for standard output)")
     parser.add_argument(
         '-s', '--start', type=datetime.fromisoformat, default=first_of_last_month,
         help="start at this date/time (YYYY-MM-DD [[HH:MM:SS]±HH:MM]; default: start of last month)")
@@ -150,6 +209,9 @@ def get_args():
     parser.add_argument(
         '--fields', default=CDR_FIELDS, type=field_list,
         help="comma-separated list of desired fields (default: all)")
+    parser.add_argument(
+        '--shards', default=1, type=positive_int,
+        help="split the period into this many parts, fetched in parallel (default: 1)")
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('--log', choices=['debug', 'info', 'warning'], default='info', 
                         help="set logging level")
@@ -159,51 +221,224 @@ def get_args():
     if args.start.tzinfo is None: args.start = args.start.replace(tzinfo=args.tz)
     if args.end.tzinfo is None: args.end = args.end.replace(tzinfo=args.tz)
 
+    # Keep the start and end as POSIX timestamps (whole seconds), for comparing and for 
+    # building the Twilio API filters.
+    args.start_ts = int(args.start.timestamp())
+    args.end_ts = int(args.end.timestamp())
+
     # Validate arguments.
-    if args.start >= args.end: parser.error("Start date is after end date")
+    if args.start_ts >= args.end_ts: parser.error("Start date is after end date")
     if not args.account: parser.error("No account SID found")
     if not args.pw: parser.error("No auth token found")
 
     return args
 
 
-# Generator function that gets calls over the specified period for 
-# the specified account, and optionally for its subaccounts.  
-def calls(args):
-    client = Client(args.account, args.pw)
-
+# Format a POSIX timestamp as a UTC date/time string for the Twilio API.  Twilio expects
+# UTC, but its helper library formats datetimes with a 'Z' suffix without converting 
+# them, so we pass strings instead.
+def utc_string(timestamp):
+    return time.strftime(UTC_FORMAT, time.gmtime(timestamp))
+
+
+# Return the account, or the account and its subaccounts, whose CDRs are wanted.  They
+# all belong to the one client, so they share its HTTP session and connection pool, 
+# rather than each paying for its own TLS handshakes.
+def get_accounts(client, args):
+    if args.subs:
+        return client.api.accounts.list()
+    else:
+        return [client.api.accounts(args.account).fetch()]
+
+
+# Size the client's HTTP connection pool to the number of fetcher threads, so that each
+# thread can keep its connection open between requests; otherwise connections beyond
+# the pool size are discarded after use.  Any retry setting of the client is kept.
+def size_connection_pool(client, num_workers):
+    from requests.adapters import HTTPAdapter
+    session = client.http_client.session
+    if session is None: return
+    adapter = session.adapters.get('https://')
+    max_retries = adapter.max_retries if adapter else 0
+    session.mount('https://', HTTPAdapter(pool_maxsize=num_workers, max_retries=max_retries))
+
+
+# Split the period into the given number of shards of (nearly) equal length, and return
+# a list of (start, end) timestamps.  Twilio's start time filters include both ends, so
+# each shard but the last ends a second before the next one starts; otherwise a call
+# starting on the boundary would be fetched twice.  No shard is shorter than a second.
+def split_period(start_ts, end_ts, shards):
+    shards = min(shards, end_ts - start_ts)
+    bounds = [start_ts + (end_ts - start_ts) * i // shards for i in range(shards + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(shards - 1)] + [(bounds[-2], end_ts)]
+
+
+# Generator function that gets calls over the specified period for the specified account.
+def calls(account, start_ts, end_ts):
+    yield from account.calls.stream(
+        start_time_after=utc_string(start_ts), start_time_before=utc_string(end_ts), 
+        page_size=PAGE_SIZE)
+
+
+# Generator function that fetches the CDRs on background threads and returns them in
+# batches, so that waiting on Twilio for the next page overlaps with writing the CSV 
+# file.  Each account, and each shard of the period if it has been split, is fetched by
+# its own worker thread, so the batches for different subaccounts and shards may be 
+# interleaved.  There are up to MAX_WORKERS threads, or one per shard if more, but never
+# more than MAX_THREADS; the client's connection pool is sized to match.
+#
+# The queue is bounded, so the fetchers can't get too far ahead of the writer.  Any
+# exception in a fetcher is passed through the queue straight away, and the other 
+# fetchers are told to stop; the exception is raised again here.  If the writer stops,
+# for whatever reason, the fetchers stop too, rather than wait on a full queue.
+def call_batches(args):
+    from twilio.rest import Client
+    from twilio.base.exceptions import TwilioException
+    batches = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()        # Set when the fetchers should give up
+    closed = threading.Event()      # Set when nothing more will be taken from the queue
+    info_enabled = logger.isEnabledFor(logging.INFO)
+
+    def put(item):
+        while not closed.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch(account, start_ts, end_ts, first_shard):
+        try:
+            if stop.is_set(): return
+            if first_shard and info_enabled:
+                logger.info("Getting CDRs for account %s (%s)", account.sid, account.friendly_name)
+            batch = []
+            for call in calls(account, start_ts, end_ts):
+                if stop.is_set(): return
+                batch.append(call)
+                if len(batch) >= BATCH:
+                    put(batch)
+                    batch = []
+            if batch: put(batch)
+        except BaseException as ex:
+            stop.set()
+            put(ex)
+
+    def fetch_all():
+        try:
+            client = Client(args.account, args.pw)
+            accounts = get_accounts(client, args)
+            shards = split_period(args.start_ts, args.end_ts, args.shards)
+            num_workers = max(1, min(len(accounts) * len(shards), 
+                                     max(MAX_WORKERS, len(shards)), MAX_THREADS))
+            size_connection_pool(client, num_workers)
+
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for account in accounts:
+                    for i, (start_ts, end_ts) in enumerate(shards):
+                        executor.submit(fetch, account, start_ts, end_ts, i == 0)
+            put(None)
+        except BaseException as ex:
+            put(ex)
+
+    threading.Thread(target=fetch_all, daemon=True).start()
     try:
-        if args.subs:
-            accounts = client.api.accounts.list()
+        while True:
+            batch = batches.get()
+            if batch is None: return
+            if isinstance(batch, TwilioException):
+                sys.exit(f"Unable to get CDRS: check credentials. Full message:\n{batch}")
+            if isinstance(batch, BaseException): raise batch
+            yield batch
+    finally:
+        stop.set()
+        closed.set()
+
+
+# Write a batch of CDRs to the string buffer.  Almost all CDR fields are SIDs, timestamps,
+# numbers and phone numbers, which never need quoting, so we simply join the fields with 
+# commas.  Only the free-text fields (the risky columns, given by their indices) can 
+# contain quotes or line breaks, so only they are searched; a stray comma anywhere shows
+# up as an extra separator.  If the row needs quoting, we fall back to the CSV writer for
+# that row; likewise for a single empty field, which must be written as "".  Plain rows
+# are written together, so that the output stays in order.
+def write_batch(buffer, writer, cdrs, risky):
+    lines = []
+
+    append = lines.append               # Local names for the lookups made for every row
+    join = ','.join
+    needs_quoting = NEEDS_QUOTING.search
+
+    for cdr in cdrs:
+        fields = ['' if value is None else str(value) for value in cdr]
+        line = join(fields)
+        if (line and line.count(',') == len(fields) - 1 
+                and not (risky and needs_quoting(''.join([fields[i] for i in risky])))):
+            append(line)
         else:
-            accounts = [client.api.accounts(args.account).fetch()]
+            if lines:
+                buffer.write(LINE_END.join(lines) + LINE_END)
+                lines.clear()
+            writer.writerow(fields)
+    if lines: buffer.write(LINE_END.join(lines) + LINE_END)
 
-        for account in accounts:      
-            logger.info("Getting CDRs for account %s (%s)", account.sid, account.friendly_name)
-            client = Client(args.account, args.pw, account.sid)
-            calls = client.calls.list(start_time_after=args.start, start_time_before=args.end)
-            for call in calls:
-                yield call
 
-    except TwilioException as ex:
-        sys.exit(f"Unable to get CDRS: check credentials. Full message:\n{ex}")                    
+# Write the contents of the string buffer to the (unbuffered) file as UTF-8, and empty 
+# the buffer.  A raw file may accept only part of the data, so keep going until it's done.
+def flush_buffer(cdr_file, buffer):
+    data = memoryview(buffer.getvalue().encode('utf-8'))
+    while data: data = data[cdr_file.write(data):]
+    buffer.seek(0)
+    buffer.truncate()
 
 
 def main(args):
+    import csv
     configure_logging(level=getattr(logging, args.log.upper()))
+
+    try:
+        if args.cdr_file == '-':
+            cdr_file = open(sys.stdout.fileno(), 'wb', buffering=0, closefd=False)
+        elif args.cdr_file.endswith('.gz'):
+            cdr_file = gzip.open(args.cdr_file, 'wb', compresslevel=GZIP_LEVEL)
+        else:
+            cdr_file = open(args.cdr_file, 'wb', buffering=0)
+    except OSError as err:
+        sys.exit(f"Unable to open CDR file: {err}")
+
     logger.info("Getting CDRs for the period %s to %s", args.start, args.end)
     logger.debug("Writing CDRs...")
 
-    with args.cdr_file as cdr_file:
-        writer = csv.writer(cdr_file, args.fields)
+    # The CSV rows are built up in a string buffer, which is written to the file in large
+    # chunks.  The file itself is unbuffered, so that the chunks aren't copied twice, 
+    # unless it's being compressed.
+    with cdr_file:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, args.fields)
         writer.writerow(args.fields)
         
-        # Special case because 'from' is a reserved word in Python; must use 'from_' instead.
-        pythonic_fields = ['from_' if field == 'from' else field for field in args.fields]
+        if args.fields is CDR_FIELDS:
+            pythonic_fields = PYTHONIC_CDR_FIELDS
+        else:
+            pythonic_fields = [PYTHONIC_FIELD_MAP[field] for field in args.fields]
 
-        for call in calls(args):
-            cdr = [getattr(call, field) for field in pythonic_fields]
-            writer.writerow(cdr)
+        risky = [i for i, field in enumerate(args.fields) if field in RISKY_FIELDS]
+
+        # Fetch all the fields of a CDR with a single attrgetter, which returns a tuple
+        # (except for a single field, when it returns the bare value).
+        get_cdr = attrgetter(*pythonic_fields)
+        if len(pythonic_fields) == 1:
+            get_field = get_cdr
+            get_cdr = lambda call: (get_field(call),)
+
+        # If the fetching fails, the rows already in the buffer are still written out,
+        # so the file holds everything fetched up to that point.
+        try:
+            for batch in call_batches(args):
+                write_batch(buffer, writer, map(get_cdr, batch), risky)
+                if buffer.tell() >= CHUNK_SIZE: flush_buffer(cdr_file, buffer)
+        finally:
+            flush_buffer(cdr_file, buffer)
 
     logger.debug("Finished writing CDRs")
 
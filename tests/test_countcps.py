@@ -0,0 +1,59 @@
+from datetime import timezone
+
+import pandas as pd
+import pytest
+
+import countcps
+
+
+def test_parse_datetimes_iso_mixed_precision():
+    cdr_info = countcps.CDRinfo()
+    column = pd.Series(['2020-09-10 14:52:06', '2020-09-10 14:52:06.500', '2020-09-10 14:52:07.000'])
+    assert countcps.parse_datetimes(column, cdr_info).tolist() == [
+        pd.Timestamp('2020-09-10 14:52:06'),
+        pd.Timestamp('2020-09-10 14:52:06.500'),
+        pd.Timestamp('2020-09-10 14:52:07'),
+    ]
+
+
+def test_parse_datetimes_iso_mixed_precision_aware():
+    cdr_info = countcps.CDRinfo()
+    cdr_info.tzinfo = timezone.utc
+    column = pd.Series(['2020-09-10 14:52:06.250+00:00', '2020-09-10 14:52:06+00:00'])
+    assert countcps.parse_datetimes(column, cdr_info).tolist() == [
+        pd.Timestamp('2020-09-10 14:52:06.250', tz='UTC'),
+        pd.Timestamp('2020-09-10 14:52:06', tz='UTC'),
+    ]
+
+
+MONKEY_FORMAT = countcps.DATETIME_FORMATS['Monkey']
+CONSOLE_FORMAT = countcps.DATETIME_FORMATS['Console']
+
+
+def test_parse_fixed_width_valid():
+    column = pd.Series(['Sat, 29 Feb 2020 23:59:59 -0700', 'Thu, 10 Sep 2020 00:00:00 +0000'])
+    secs = countcps.parse_fixed_width(column, countcps.FIXED_WIDTH_FORMATS[MONKEY_FORMAT])
+    assert secs.tolist() == [
+        int(pd.Timestamp('2020-03-01 06:59:59').timestamp()),
+        int(pd.Timestamp('2020-09-10 00:00:00').timestamp()),
+    ]
+
+
+def test_parse_fixed_width_rejects_out_of_range_values():
+    layout = countcps.FIXED_WIDTH_FORMATS[CONSOLE_FORMAT]
+    for value in ['14:52:06 EDT 2020-13-10', '14:52:06 EDT 2020-00-10', '14:52:06 EDT 2020-09-32',
+                  '14:52:06 EDT 2020-09-31', '14:52:06 EST 2019-02-29', '24:00:00 EDT 2020-09-10',
+                  '14:60:06 EDT 2020-09-10', '14:52:60 EDT 2020-09-10', '14:52:06 EDT 2020-09-00']:
+        assert countcps.parse_fixed_width(pd.Series([value]), layout) is None, value
+
+    layout = countcps.FIXED_WIDTH_FORMATS[MONKEY_FORMAT]
+    for value in ['Sat, 12 Sep 2020 10:30:05 -2400', 'Sat, 12 Sep 2020 10:30:05 -0760']:
+        assert countcps.parse_fixed_width(pd.Series([value]), layout) is None, value
+
+
+def test_parse_datetimes_rejects_out_of_range_values():
+    cdr_info = countcps.CDRinfo()
+    cdr_info.datetime_format = CONSOLE_FORMAT
+    column = pd.Series(['14:52:06 EDT 2020-09-10', '14:52:06 EDT 2020-09-31'])
+    with pytest.raises(ValueError):
+        countcps.parse_datetimes(column, cdr_info)
@@ -0,0 +1,34 @@
+import getcdrs
+
+
+def covered_seconds(shards):
+    seconds = []
+    for start, end in shards:
+        assert start <= end
+        seconds.extend(range(start, end + 1))
+    return seconds
+
+
+def test_split_period_single_shard():
+    assert getcdrs.split_period(100, 200, 1) == [(100, 200)]
+
+
+def test_split_period_boundaries():
+    shards = getcdrs.split_period(0, 10, 3)
+    assert shards == [(0, 2), (3, 5), (6, 10)]
+    for (_, end), (next_start, _) in zip(shards, shards[1:]):
+        assert next_start == end + 1        # Contiguous, with no second in two shards
+
+
+def test_split_period_covers_each_second_once():
+    start, end = 1614556800, 1614556800 + 31 * 86400
+    for num_shards in (1, 2, 7, 31, 1000):
+        shards = getcdrs.split_period(start, end, num_shards)
+        assert len(shards) == num_shards
+        assert covered_seconds(shards) == list(range(start, end + 1))
+
+
+def test_split_period_more_shards_than_seconds():
+    shards = getcdrs.split_period(50, 53, 10)
+    assert shards == [(50, 50), (51, 51), (52, 53)]
+    assert covered_seconds(shards) == [50, 51, 52, 53]